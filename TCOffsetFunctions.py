@@ -1,7 +1,15 @@
 import numpy as np
 import scipy.spatial.distance as ssd
+from scipy.spatial import cKDTree
 import astropy.io.fits as apfits
 
+#numba is optional, without it greedy_match runs as regular python.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 
 ### cull_matches ###
 
@@ -126,6 +134,93 @@ def cull_matches(source_xoffs,source_yoffs,cutoff):
 
     return good_ind,stdx,stdy
 
+### read_catalog ###
+# Reads the columns needed for matching from a gaussclumps catalog. The table
+# is memory mapped so only these columns are read from disk.
+#
+# Keywords:
+# cat_name - name of the gaussclumps catalog in .fits format (string).
+#          -- required
+#
+# Returns:
+# posxvals, posyvals - RA and Dec of the sources in degrees (float array).
+# peakvals - peak brightness of the sources (float array).
+# fwhm1vals, fwhm2vals - FWHM of the sources along each axis in pixels
+#           (float array).
+
+def read_catalog(cat_name):
+
+    with apfits.open(cat_name, memmap=True) as cat_hdul:
+        cat_data = cat_hdul[1].data
+
+        #Copy the columns out as native, contiguous arrays before the file
+        # is closed.
+        posxvals = np.ascontiguousarray(cat_data['Cen1'], dtype=np.float64)
+        posyvals = np.ascontiguousarray(cat_data['Cen2'], dtype=np.float64)
+        peakvals = np.ascontiguousarray(cat_data['Peak'], dtype=np.float64)
+        fwhm1vals = np.ascontiguousarray(cat_data['GCFWHM1'], dtype=np.float64)
+        fwhm2vals = np.ascontiguousarray(cat_data['GCFWHM2'], dtype=np.float64)
+    ##with
+
+    return posxvals, posyvals, peakvals, fwhm1vals, fwhm2vals
+#def
+
+### greedy_match ###
+# Assigns each reference source the closest available target source within
+# the matching distance. Reference sources are visited in array order, so
+# earlier sources get priority. Candidate targets for the i'th reference
+# source are cand_ind[cand_ptr[i]:cand_ptr[i+1]]. Compiled with numba when it
+# is available.
+#
+# Keywords:
+# ref_posxvals, ref_posyvals - reference RA and Dec in degrees (float array).
+# ref_cosdec - cosine of the reference declinations (float array).
+# targ_posxvals, targ_posyvals - target RA and Dec in degrees (float array).
+# cand_ptr - start of each reference source's candidates in cand_ind, with
+#           one extra element marking the end (int array).
+# cand_ind - indices of candidate target sources, sorted within each
+#           reference source (int array).
+# maxsep_sq - square of the maximum allowed separation between two sources to
+#           match them, in degrees^2 (float).
+#
+# Returns:
+# matched_sources - index of the target source matched to each reference
+#           source, or -1 if there is no match (int array).
+
+@njit(cache=True, fastmath=True)
+def greedy_match(ref_posxvals, ref_posyvals, ref_cosdec, targ_posxvals,
+                 targ_posyvals, cand_ptr, cand_ind, maxsep_sq):
+
+    matched_sources = np.full(len(ref_posxvals), -1, dtype=np.int64)
+    targ_available = np.ones(len(targ_posxvals), dtype=np.bool_)
+
+    for i in range(len(ref_posxvals)):
+
+        #Find the closest available candidate within the matching distance.
+        # Squared distances order the same way, so no sqrt is needed.
+        mindist_sq = maxsep_sq
+        match_ind = -1
+        for m in range(cand_ptr[i], cand_ptr[i+1]):
+            j = cand_ind[m]
+            if not targ_available[j]: continue
+            dx = (ref_posxvals[i]-targ_posxvals[j])*ref_cosdec[i]
+            dy = ref_posyvals[i]-targ_posyvals[j]
+            dist_sq = dx*dx+dy*dy
+            if dist_sq < mindist_sq:
+                mindist_sq = dist_sq
+                match_ind = j
+            ##fi
+        ###m
+
+        if match_ind >= 0:
+            targ_available[match_ind] = False
+            matched_sources[i] = match_ind
+        ##fi
+    ###i
+
+    return matched_sources
+#def
+
 ### source_match ###
 # Takes a gaussclumps catalog for a target image and compares the catalog
 # to a reference catalog to find matches and report offsets in position and
@@ -141,146 +236,107 @@ def cull_matches(source_xoffs,source_yoffs,cutoff):
 # maxsep - maximum allowed separation between two sources to match them (").
 #
 # Output:
-# off - a 4-element array that gives the x and y offset of the target image
-#           with respect to the reference image (ie: target - reference) as well
-#           as peak and radius ratios (ie: target / reference). All values are
-#           averages.
-# err - a 4-element array that gives the standard deviation in each of the above
-#           measurements, respectively.
+# off - a 4-element float64 array that gives the x and y offset of the target
+#           image with respect to the reference image (ie: target - reference)
+#           as well as peak and radius ratios (ie: target / reference). All
+#           values are averages. NaN if no sources were matched.
+# err - a 4-element float64 array that gives the standard deviation in each of
+#           the above measurements, respectively. NaN if no sources were matched.
 
 def source_match(cat_name, ref_name, minpeak=0.2, maxrad=15, maxsep=10, cutoff=4, pix_scale=3.0):
 
     #Read in the reference catalog and prepare the data.
-    ref_data = apfits.getdata(ref_name, 0)
-    ref_nsources = len(ref_data['Cen1'])
-    ref_posxvals = ref_data['Cen1']
-    ref_posyvals = ref_data['Cen2']
-    ref_peakvals = ref_data['Peak']
-    ref_fwhm1vals = ref_data['GCFWHM1']
-    ref_fwhm2vals = ref_data['GCFWHM2']
+    ref_posxvals, ref_posyvals, ref_peakvals, ref_fwhm1vals, ref_fwhm2vals = \
+        read_catalog(ref_name)
+    ref_nsources = len(ref_posxvals)
 
     #Calculate the effective radius, the square root of the two FWHM multiplied
     # together. Multiply by 1.5 to account for FWHM is diameter but want radius (divide by 2),
     # and units are pixels but want arcseconds (multiply by 3 - SHOULD MAKE THIS PIX_SCALE BECAUSE 450 DATA HAS 2 ARCSECOND PIXELS).
-    ref_rvals = np.sqrt( np.multiply( ref_fwhm1vals, ref_fwhm2vals ) ) * pix_scale/2.0
-
-    #Keep an array to track index of successful matches in the target catalog.
-    matched_sources = np.zeros(ref_nsources)
-    matched_sources[:] = -1
+    # Done in place on a single array to avoid extra temporaries.
+    ref_rvals = np.multiply( ref_fwhm1vals, ref_fwhm2vals )
+    np.sqrt( ref_rvals, out=ref_rvals )
+    ref_rvals *= pix_scale/2.0
 
     #Read in the target catalog and prepare the data.
-    targ_data = apfits.getdata(cat_name, 0)
-    targ_nsources = len(targ_data['Cen1'])
-    targ_posxvals = targ_data['Cen1']
-    targ_posyvals = targ_data['Cen2']
-    targ_peakvals = targ_data['Peak']
-    targ_fwhm1vals = targ_data['GCFWHM1']
-    targ_fwhm2vals = targ_data['GCFWHM2']
+    targ_posxvals, targ_posyvals, targ_peakvals, targ_fwhm1vals, targ_fwhm2vals = \
+        read_catalog(cat_name)
+    targ_nsources = len(targ_posxvals)
 
     #Calculate effective radius, same as above CHANGE THIS TOO, LIKE ABOVE.
-    targ_rvals = np.sqrt( np.multiply( targ_fwhm1vals, targ_fwhm2vals ) ) * pix_scale/2.0
-
-    #Keep an array to track whether or not target catalog sources have found
-    # a match, because they can't match more than once. Brightest sources
-    # get priority.
-    targ_matchcheck = np.zeros(targ_nsources)
-
-    #Loop over all sources in the reference catalog.
-    for i in range(ref_nsources):
-
-        #Test a radius and peak condition here:
-        if ref_rvals[i] > maxrad: continue
-        if ref_fwhm1vals[i]*pix_scale/2.0>maxrad:continue
-        if ref_fwhm2vals[i]*pix_scale/2.0>maxrad:continue
-        if ref_peakvals[i] < minpeak: continue
-
-        #Declare the reference coordinates.
-        ref_coords = np.array([[ref_posxvals[i], ref_posyvals[i]],])
+    targ_rvals = np.multiply( targ_fwhm1vals, targ_fwhm2vals )
+    np.sqrt( targ_rvals, out=targ_rvals )
+    targ_rvals *= pix_scale/2.0
+
+    #Test the radius and peak conditions for all reference sources at once.
+    valid = ( (ref_rvals <= maxrad) &
+              (ref_fwhm1vals*pix_scale/2.0 <= maxrad) &
+              (ref_fwhm2vals*pix_scale/2.0 <= maxrad) &
+              (ref_peakvals >= minpeak) )
+
+    #Keep only the reference sources that passed the conditions, ordered from
+    # brightest to faintest so that the brightest sources get first pick of
+    # the targets. There is no cut on the targets, since a source that has
+    # brightened or grown is exactly what we want to match.
+    keep_ind = np.argsort(-ref_peakvals, kind='stable')
+    keep_ind = keep_ind[valid[keep_ind]]
+    keep_posxvals = ref_posxvals[keep_ind]
+    keep_posyvals = ref_posyvals[keep_ind]
+
+    #RA offsets are corrected by the cosine of the reference declination.
+    ref_cosdec = np.cos(ref_posyvals*np.pi/180.0)
+    keep_cosdec = ref_cosdec[keep_ind]
 
-        #Set a minimum distance tracking variable and the matched source
-        # indexing variable.
-        mindist = -1
-        match_ind = -1
-
-        #Loop over the target catalog sources.
-        for j in range(targ_nsources):
-
-            #Don't match a source that already has a match.
-            if targ_matchcheck[j] == 1: continue
-
-            #Declare the target coordinates
-            targ_coords = np.array([[targ_posxvals[j], targ_posyvals[j]],])
-
-            #Calculate distance.
-            #dist = ssd.cdist(ref_coords, targ_coords, metric='euclidean')
-            dist = 3600.0*np.sqrt(((ref_coords[0][0]-targ_coords[0][0])*np.cos(ref_coords[0][1]*np.pi/180.0))**2.0+(ref_coords[0][1]-targ_coords[0][1])**2.0)
-            #Check if this source meets the criterion for matching distance.
-            if dist < maxsep:
-
-                #If this is the first iteration then mindist will be -1
-                if mindist == -1:
-                    #Auto assign mindist and match_ind
-                    match_ind = j
-                    mindist = dist
-                ###fi
-
-                #Now check if a new closest source.
-                if dist < mindist:
-                    #Remember the new source number and assign dist to mindist.
-                    match_ind = j
-                    mindist = dist
-                    ###fi
-            ###fi
-        ###j
-
-        #If we are at the end of the reference catalog then assign
-        # this source if it found a match.
-        if match_ind >= 0:
-            targ_matchcheck[match_ind] = 1
-            matched_sources[i] = match_ind
-        ##fi
-    ###i
+    #Keep an array to track index of successful matches in the target catalog.
+    matched_sources = np.full(ref_nsources, -1, dtype=np.int64)
+
+    if len(keep_ind) > 0 and targ_nsources > 0:
+
+        #Put the target sources in a tree (in ") to find the candidates near
+        # each reference source without calculating every distance. Scaling
+        # RA by the smallest cos(dec) means the tree distance is never larger
+        # than the true distance, so no candidate within maxsep is missed.
+        cosdec_min = np.amin(keep_cosdec)
+        targ_tree = cKDTree( np.column_stack(
+                        [targ_posxvals*cosdec_min, targ_posyvals] )*3600.0 )
+        ref_candidates = targ_tree.query_ball_point( np.column_stack(
+                        [keep_posxvals*cosdec_min, keep_posyvals] )*3600.0,
+                         maxsep, return_sorted=True )
+
+        #Flatten the candidate lists so the matching can run compiled.
+        cand_ptr = np.zeros(len(keep_ind)+1, dtype=np.int64)
+        cand_ptr[1:] = np.cumsum([len(c) for c in ref_candidates])
+        cand_ind = np.concatenate([np.array(c, dtype=np.int64)
+                                   for c in ref_candidates])
+
+        #Match the kept sources, then map back to the full reference catalog.
+        matched_sources[keep_ind] = greedy_match(
+                        keep_posxvals, keep_posyvals, keep_cosdec,
+                        targ_posxvals, targ_posyvals,
+                        cand_ptr, cand_ind, (maxsep/3600.0)**2.0)
+    ##fi
 
     #Find out the number of matched sources.
-    n_matched = len(np.where(matched_sources != -1)[0])
+    matched_mask = matched_sources != -1
+    n_matched = int(np.count_nonzero(matched_mask))
     print('\n'+str(n_matched)+' sources were matched!\n')
 
     if n_matched > 0:
 
         #Where matched_sources is greater than -1, the reference catalogue has a match. 
         #The value of matched_sources gives the index of the target catalogue source to which it is matched
-        ref_sources_with_match=np.where(matched_sources != -1)
-    
+        ref_sources_with_match = np.where(matched_mask)
+        corresponding_targ_sources = matched_sources[matched_mask].astype(int)
+
+        #Now find the offset (") between the matched reference and target sources as well as the peak ratios and radius ratios:
+        ri = ref_sources_with_match[0]
+        tj = corresponding_targ_sources
+        matched_xoff = (targ_posxvals[tj]-ref_posxvals[ri])*ref_cosdec[ri]*3600.0
+        matched_yoff = (targ_posyvals[tj]-ref_posyvals[ri])*3600.0
+        matched_peakr = targ_peakvals[tj]/ref_peakvals[ri]
+        matched_rr = targ_rvals[tj]/ref_rvals[ri]
 
-        #Get rid of all the sources that do not match in the reference catalogue
-        ref_peakvals=np.array(ref_peakvals)[ref_sources_with_match]
-        ref_posxvals=np.array(ref_posxvals)[ref_sources_with_match]
-        ref_posyvals=np.array(ref_posyvals)[ref_sources_with_match]
-        ref_rvals=np.array(ref_rvals)[ref_sources_with_match]
-
-        #matched_sources is the array containing the index of the target catalogue's matching sources
-        corresponding_targ_sources=np.array(matched_sources)[np.where(matched_sources != -1)]
-        corresponding_targ_sources=corresponding_targ_sources.astype(int)
-
-        #Get rid of all the sources that do not match in the target catalogue
-        targ_peakvals=np.array(targ_peakvals)[corresponding_targ_sources]
-        targ_posxvals=np.array(targ_posxvals)[corresponding_targ_sources]
-        targ_posyvals=np.array(targ_posyvals)[corresponding_targ_sources]
-        targ_rvals=np.array(targ_rvals)[corresponding_targ_sources]
-
-        #Now find the offset between the matched reference and target sources as well as the peak ratios and radius ratios:
-        matched_xoff=[]
-        matched_yoff=[]
-        matched_peakr=[]
-        matched_rr=[]
-        for i in range(len(np.where(matched_sources != -1)[0])):
-            #Convert offsets into arcseconds^2
-            matched_xoff.append(((targ_posxvals[i])-(ref_posxvals[i]))*np.cos(ref_posyvals[i]*np.pi/180.0)*3600.0)
-            matched_yoff.append((targ_posyvals[i]-ref_posyvals[i])*3600.0)
-            matched_peakr.append(targ_peakvals[i]/ref_peakvals[i])
-            matched_rr.append(targ_rvals[i]/ref_rvals[i])
-
-        number_of_sources_matched=len(np.where(matched_sources != -1)[0])
+        number_of_sources_matched = n_matched
 
         #Now, find the index and the standard deviation for all the sources which survived the cull
         culled_ind,stdx,stdy=cull_matches(matched_xoff,matched_yoff,cutoff)
@@ -289,10 +345,10 @@ def source_match(cat_name, ref_name, minpeak=0.2, maxrad=15, maxsep=10, cutoff=4
 
 
         #Calculate averages.
-        avg_xoff = np.average(np.array(matched_xoff)[culled_ind])
-        avg_yoff = np.average(np.array(matched_yoff)[culled_ind])
-        avg_peakr = np.average(np.array(matched_peakr)[culled_ind])
-        avg_rr = np.average(np.array(matched_rr)[culled_ind])
+        avg_xoff = np.average(matched_xoff[culled_ind])
+        avg_yoff = np.average(matched_yoff[culled_ind])
+        avg_peakr = np.average(matched_peakr[culled_ind])
+        avg_rr = np.average(matched_rr[culled_ind])
 
         #Calculate error.
         std_xoff = stdx
@@ -314,11 +370,11 @@ def source_match(cat_name, ref_name, minpeak=0.2, maxrad=15, maxsep=10, cutoff=4
             std_peakr = np.std(matched_peakr)
             std_rr = np.std(matched_rr)
 
-        return [avg_xoff,avg_yoff,avg_peakr,avg_rr], [std_xoff,std_yoff,std_peakr,std_rr], [len(culled_ind)], [number_of_sources_matched], np.where(matched_sources != -1), corresponding_targ_sources,np.where(matched_sources != -1)[0][culled_ind],corresponding_targ_sources[culled_ind]
+        return np.array([avg_xoff,avg_yoff,avg_peakr,avg_rr], dtype=np.float64), np.array([std_xoff,std_yoff,std_peakr,std_rr], dtype=np.float64), [len(culled_ind)], [number_of_sources_matched], ref_sources_with_match, corresponding_targ_sources,ri[culled_ind],corresponding_targ_sources[culled_ind]
     ##fi
 
-    #If no sources found return None.
+    #If no sources found return NaN.
     if n_matched == 0:
         print('\nNo sources found.\n')
-        return [None,None,None,None], [None,None,None,None],[0], [0], [0], [0], [0], [0]
+        return np.full(4, np.nan), np.full(4, np.nan),[0], [0], [0], [0], [0], [0]
 #def
@@ -1,11 +1,27 @@
+import os
+import re
+import shutil
+import tempfile
+import functools
 import subprocess
 import pdb
+from concurrent.futures import ProcessPoolExecutor
+import astropy.io.fits as apfits
+
+#starlink.hds (from starlink-pyhds or starlink-pyndf) is optional, without it
+# KAPPA is used to inspect .sdf files. All direct .sdf access goes through the
+# functions below.
+try:
+    from starlink import hds
+except ImportError:
+    hds = None
 
 ##### Image Preparation Functions #####
 
 ### crop_image ###
 # Takes an image in .sdf form and crops it to a given radius. The standard
-# output is "img_name"_crop.sdf
+# output is "img_name"_crop.sdf, which is moved next to the image if PICARD
+# writes it to a different ORAC_DATA_OUT.
 #
 # Keywords:
 # img_name - name of the image (string). -- required
@@ -15,58 +31,236 @@ import pdb
 
 def crop_image(img_name, crop_radius=1200, crop_method='CIRCLE'):
 
-    #Make the cropping parameter file.
-    crop_parms = open('crop.ini', 'w')
+    #Make the cropping parameter file. Use a temporary file so that images
+    # can be cropped in parallel without sharing it.
+    crop_parms = tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False)
     crop_parms.write('[CROP_SCUBA2_IMAGES]\n')
     crop_parms.write('CROP_METHOD = '+str(crop_method)+'\n')
     crop_parms.write('MAP_RADIUS = '+str(crop_radius)+'\n')
     crop_parms.close()
 
     #Perform the cropping.
-    crop_command = '${ORAC_DIR}/etc/picard_start.sh CROP_SCUBA2_IMAGES '
-    crop_command += '-log f -recpars crop.ini '+img_name+' ${1+"$@"};'
-    subprocess.call(crop_command, shell=True)
+    try:
+        crop_command = [os.environ['ORAC_DIR']+'/etc/picard_start.sh',
+                        'CROP_SCUBA2_IMAGES', '-log', 'f',
+                        '-recpars', crop_parms.name,
+                        os.path.abspath(img_name)]
+        subprocess.run(crop_command, check=True)
+    finally:
+        os.unlink(crop_parms.name)
+    ##try
+
+    #PICARD writes to ORAC_DATA_OUT, or the current directory if it isn't set.
+    crop_name = img_name[:-4]+'_crop.sdf'
+    crop_out = os.path.join(os.environ.get('ORAC_DATA_OUT', '.'),
+                            os.path.basename(crop_name))
+    if os.path.realpath(crop_out) != os.path.realpath(crop_name):
+        shutil.move(crop_out, crop_name)
+    ##fi
     print('\nCROP = DONE\n')
 
 #def
 
+### get_kernel_dims ###
+# Finds the size of a kernal in .sdf form. Read directly from the file if
+# starlink.hds is available, otherwise with a single ndftrace call. Sizes are
+# cached per kernal file and modification time, so repeated calls with the
+# same kernal don't read it again.
+#
+# Keywords:
+# kern_name - name of the kernal .sdf (string). -- required
+#
+# Returns:
+# naxis1_size - size of the first axis in pixels (int).
+# naxis2_size - size of the second axis in pixels (int).
+
+def get_kernel_dims(kern_name):
+
+    #The real path and modification time make up the cache key.
+    kern_path = os.path.realpath(kern_name)
+    if not kern_path.endswith('.sdf'):
+        kern_path += '.sdf'
+    ##fi
+    return _kernel_dims(kern_path, os.path.getmtime(kern_path))
+
+#def
+
+#Does the lookup for get_kernel_dims, kern_mtime is only part of the cache key.
+@functools.lru_cache(maxsize=32)
+def _kernel_dims(kern_name, kern_mtime):
+
+    if hds is not None:
+        #Read the dimensions of the data array. starlink.hds gives the shape
+        # in numpy order, which is the reverse of the NDF (and ndftrace) axis
+        # order. Other array forms are left to ndftrace.
+        kern_loc = hds.open(kern_name, 'READ')
+        data_loc = find_array_values(kern_loc, 'DATA_ARRAY')
+        kern_dims = None
+        if data_loc is not None:
+            kern_dims = [int(d) for d in data_loc.shape[::-1]]
+        ##fi
+        kern_loc.annul()
+        if kern_dims is not None:
+            return kern_dims[0], kern_dims[1]
+        ##fi
+    ##fi
+
+    #Trace the kernal and pull the dimensions out of the output.
+    trace_command = [os.environ['KAPPA_DIR']+'/ndftrace', 'ndf='+kern_name]
+    trace_proc = subprocess.run(trace_command, check=True,
+                                stdout=subprocess.PIPE)
+    dims_match = re.search(r'Dimension size\(s\):\s*([\d x]+)',
+                           trace_proc.stdout.decode())
+    naxis1_size, naxis2_size = [int(d) for d in dims_match.group(1).split('x')][:2]
+
+    return naxis1_size, naxis2_size
+
+#def
+
+### read_fits_keyword ###
+# Returns the value of a FITS header keyword of an image in .sdf form. The
+# FITS extension is read directly if starlink.hds is available, otherwise
+# with KAPPA fitsval.
+#
+# Keywords:
+# img_name - name of the image (string). -- required
+# keyword - FITS keyword to read (string). -- required
+#
+# Returns:
+# value - the value of the keyword (string).
+
+def read_fits_keyword(img_name, keyword):
+
+    if hds is not None:
+        #The FITS extension holds the header as an array of 80 character cards.
+        img_loc = hds.open(img_name, 'READ')
+        fits_cards = img_loc.find('MORE').find('FITS').get()
+        img_loc.annul()
+        fits_header = apfits.Header.fromstring('\n'.join(
+                          card.decode() for card in fits_cards), sep='\n')
+        return str(fits_header[keyword])
+    ##fi
+
+    fitsval_command = [os.environ['KAPPA_DIR']+'/fitsval', 'ndf='+img_name,
+                       'keyword='+keyword]
+    fitsval_proc = subprocess.run(fitsval_command, check=True,
+                                  stdout=subprocess.PIPE)
+    return fitsval_proc.stdout.decode().strip()
+
+#def
+
 ### smooth_image ###
 # Takes an image in .sdf form and smooths it with a kernal in .sdf form.
-# output is "img_name"_smooth.sdf
+# Default output is "img_name"_smooth.sdf
 #
 # Keywords:
 # img_name - name of the image (string). -- required
 # kern_name - name of the kernal .sdf to smooth with (string). -- required
+# out_name - name of the smoothed image (string).
 
-def smooth_image(img_name, kern_name):
-
-    #Determine the size of the kernal file.
-    naxis1_command = '$KAPPA_DIR/fitsval ndf='+kern_name+' keyword=NAXIS1'
-    naxis2_command = '$KAPPA_DIR/fitsval ndf='+kern_name+' keyword=NAXIS2'
+def smooth_image(img_name, kern_name, out_name=None):
 
-    naxis1_proc = subprocess.Popen(naxis1_command, shell=True,
-                                    stdout=subprocess.PIPE)
-    naxis1_stdout = naxis1_proc.communicate()
-    naxis1_size = int(str(naxis1_stdout[0])[2:-3])
+    if out_name is None:
+        out_name = img_name[:-4]+'_smooth.sdf'
+    ##fi
 
-    naxis2_proc = subprocess.Popen(naxis2_command, shell=True,
-                                    stdout=subprocess.PIPE)
-    naxis2_stdout = naxis2_proc.communicate()
-    naxis2_size = int(str(naxis2_stdout[0])[2:-3])
+    #Determine the size of the kernal file.
+    naxis1_size, naxis2_size = get_kernel_dims(kern_name)
 
     #Assume that the center of the kernal is at the center of the .sdf
     xcenter = round(naxis1_size/2)
     ycenter = round(naxis2_size/2)
 
     #Write the smoothing command.
-    smooth_command = '$KAPPA_DIR/convolve in='+img_name+' psf='+kern_name+' '
-    smooth_command += 'out='+img_name[:-4]+'_smooth.sdf '
-    smooth_command += 'xcentre='+str(xcenter)+' ycentre='+str(ycenter)
-    subprocess.call(smooth_command, shell=True)
+    smooth_command = [os.environ['KAPPA_DIR']+'/convolve', 'in='+img_name,
+                      'psf='+kern_name, 'out='+out_name,
+                      'xcentre='+str(xcenter), 'ycentre='+str(ycenter)]
+    subprocess.run(smooth_command, check=True)
     print('\nSMOOTH = DONE\n')
 
 #def
 
+### find_array_values ###
+# Finds the primitive holding the values of an NDF array component, which is
+# either the component itself or the DATA of a simple ARRAY structure. Needs
+# starlink.hds.
+#
+# Keywords:
+# ndf_loc - locator of the NDF (hds locator). -- required
+# comp_name - name of the array component, e.g. DATA_ARRAY (string). -- required
+#
+# Returns:
+# values_loc - locator of the values, None if the component is missing or
+# stored some other way, e.g. as a scaled array (hds locator).
+
+def find_array_values(ndf_loc, comp_name):
+
+    comp_names = [ndf_loc.index(i).name for i in range(ndf_loc.ncomp)]
+    if comp_name not in comp_names:
+        return None
+    ##fi
+
+    array_loc = ndf_loc.find(comp_name)
+    if not array_loc.struc:
+        return array_loc
+    ##fi
+
+    #ARRAY structures without a VARIANT are simple.
+    array_comps = [array_loc.index(i).name for i in range(array_loc.ncomp)]
+    if 'VARIANT' in array_comps:
+        if array_loc.find('VARIANT').get().strip() != b'SIMPLE':
+            return None
+        ##fi
+    ##fi
+    return array_loc.find('DATA')
+
+#def
+
+### scale_ndf ###
+# Multiplies an NDF in .sdf form by a constant in place: bad pixels are left
+# bad and the variance is multiplied by the square of the constant, as with
+# KAPPA cmult. Only floating point arrays stored as primitives or simple
+# arrays are handled, the NDF is left untouched otherwise. Needs starlink.hds.
+#
+# Keywords:
+# ndf_name - name of the .sdf to scale (string). -- required
+# factor - constant to multiply by (float). -- required
+#
+# Returns:
+# scaled - whether the NDF was scaled (boolean).
+
+def scale_ndf(ndf_name, factor):
+
+    ndf_loc = hds.open(ndf_name, 'UPDATE')
+
+    #Find the arrays to scale and check they can all be handled before
+    # changing any of them.
+    comp_names = [ndf_loc.index(i).name for i in range(ndf_loc.ncomp)]
+    scale_locs = [(find_array_values(ndf_loc, comp_name), comp_factor)
+                  for comp_name, comp_factor in (('DATA_ARRAY', factor),
+                                                 ('VARIANCE', factor**2))
+                  if comp_name in comp_names]
+
+    for array_loc, comp_factor in scale_locs:
+        if array_loc is None or array_loc.type not in ('_REAL', '_DOUBLE'):
+            ndf_loc.annul()
+            return False
+        ##fi
+    ###array_loc
+
+    for array_loc, comp_factor in scale_locs:
+        #Scale the good pixels in one pass and write them back.
+        values = array_loc.get()
+        good = values != hds.getbadvalue(array_loc.type)
+        values[good] *= comp_factor
+        array_loc.put(values)
+    ###array_loc
+
+    ndf_loc.annul()
+    return True
+
+#def
+
 ### unitconv_image ###
 # Takes an image in .sdf form and converts the units to Jy/Beam. Default output
 # is "img_name"_jypbm.sdf
@@ -79,11 +273,12 @@ def smooth_image(img_name, kern_name):
 
 def unitconv_image(img_name, jypbm_conv):
 
+    out_name = img_name[:-4]+'_jypbm.sdf'
+
     #Make and execute the unit conversion command.
-    jypbm_command = '$KAPPA_DIR/cmult in='+img_name+' scalar='
-    jypbm_command += str(jypbm_conv)+' out='+img_name[:-4]
-    jypbm_command += '_jypbm.sdf'
-    subprocess.call(jypbm_command, shell=True)
+    jypbm_command = [os.environ['KAPPA_DIR']+'/cmult', 'in='+img_name,
+                     'scalar='+str(jypbm_conv), 'out='+out_name]
+    subprocess.run(jypbm_command, check=True)
 
 #def
 
@@ -107,15 +302,84 @@ def prepare_image(img_name, kern_name, kern_fwhm, jypbm_conv=0.229,
 
     #Crop the image.
     crop_image(img_name, crop_radius, crop_method)
-
-    #Smooth the image.
     img_name = img_name[:-4]+'_crop.sdf'
-    smooth_image(img_name, kern_name)
 
-    #Convert the units. First account for the smoothing by dividing new beam
-    # area by old beam area and multiplying to the Jy/Beam conversion factor.
+    #Smooth the image and convert the units. First account for the smoothing
+    # by dividing new beam area by old beam area and multiplying to the
+    # Jy/Beam conversion factor. This can't be folded into the kernal, convolve
+    # normalises its output to the mean of the input so any scaling of the PSF
+    # is lost.
     jypbm_conv *= ((beam_fwhm**2)+(kern_fwhm**2))/(beam_fwhm**2)
-    img_name = img_name[:-4]+'_smooth.sdf'
-    unitconv_image(img_name, jypbm_conv)
+
+    if hds is not None:
+        #Smooth straight into the final image and convert its units in place,
+        # skipping the intermediate _smooth.sdf.
+        out_name = img_name[:-4]+'_smooth_jypbm.sdf'
+        smooth_image(img_name, kern_name, out_name)
+        if scale_ndf(out_name, jypbm_conv):
+            return
+        ##fi
+
+        #scale_ndf can't handle this image, fall back to KAPPA cmult.
+        os.rename(out_name, img_name[:-4]+'_smooth.sdf')
+    else:
+        smooth_image(img_name, kern_name)
+    ##fi
+
+    unitconv_image(img_name[:-4]+'_smooth.sdf', jypbm_conv)
+
+#def
+
+### prepare_images ###
+# Prepares a list of images in .sdf form in parallel, running prepare_image on
+# each of them in a pool of processes. Each process gets its own ADAM_USER
+# directory so that the KAPPA tasks don't share parameter files, and its own
+# ORAC_DATA_OUT so that PICARD runs don't share their bookkeeping files
+# (log.group, rules.badobs, disp.dat).
+#
+# Keywords:
+# img_names - names of the images (list of strings). --required
+# kern_name, kern_fwhm, jypbm_conv, beam_fwhm, crop_radius, crop_method - as
+# for prepare_image.
+# n_workers - number of processes to use, defaults to the number of CPUs (int).
+
+def prepare_images(img_names, kern_name, kern_fwhm, jypbm_conv=0.229,
+                   beam_fwhm=14.5, crop_radius=1200, crop_method='CIRCLE',
+                   n_workers=None):
+
+    #All of the worker directories go in here.
+    work_dir = tempfile.mkdtemp(prefix='prepare_')
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=init_prepare_worker,
+                                 initargs=(work_dir,)) as executor:
+            list(executor.map(functools.partial(prepare_image,
+                                                kern_name=kern_name,
+                                                kern_fwhm=kern_fwhm,
+                                                jypbm_conv=jypbm_conv,
+                                                beam_fwhm=beam_fwhm,
+                                                crop_radius=crop_radius,
+                                                crop_method=crop_method),
+                              img_names))
+        ##with
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    ##try
+
+#def
+
+### init_prepare_worker ###
+# Gives a prepare_images worker process its own ADAM_USER and ORAC_DATA_OUT
+# directories.
+#
+# Keywords:
+# work_dir - directory to make the worker directories in (string). --required
+
+def init_prepare_worker(work_dir):
+
+    os.environ['ADAM_USER'] = tempfile.mkdtemp(prefix='adam_', dir=work_dir)
+    os.environ['ORAC_DATA_OUT'] = tempfile.mkdtemp(prefix='picard_',
+                                                   dir=work_dir)
 
 #def
@@ -4,11 +4,35 @@ import numpy as np
 import pdb
 import subprocess
 import matplotlib.patches as mpatches
+import matplotlib.colors as mcolors
 import matplotlib.lines as mlines
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
-from astropy.coordinates import Angle
-from astropy import units
+from TCPrepFunctions import read_fits_keyword
+
+#Integer codes for the protostellar classes of both nomenclatures, used by
+# the plotting functions in place of the class strings. See encode_proto.
+PROTO_CODES = {'P':0, 'D':1, 'FP':2, 'RP':3, 'NA':4, '0+1':5, 'F':6, '2':7,
+			   '3':8}
+
+#Legend handles for the detection types and protostellar classes. These are
+# made once on import and shared by every legend_scatter call. Each class gets
+# a colour, unmatched sources and any unknown classes are left unfilled.
+_CLASS_COLORS = ('r', 'b', 'm', 'y', 'none')
+_DETECTION_HANDLES = (mlines.Line2D((0,0),(0,0), marker = 'o',
+									mec = 'k', mfc = 'none', mew = 1.2,
+									ms = 10, linestyle = '', label='Solid'),
+					  mlines.Line2D((0,1),(0,0), marker = '^',
+									mec = 'k', mfc = 'none', mew = 1.2,
+									ms = 10, linestyle = '', label='Partial'))
+_ORION_HANDLES = _DETECTION_HANDLES + tuple(
+					mpatches.Patch(fc = color, ec = 'k', label = label)
+					for label, color in zip(('P', 'D', 'FP', 'RP', 'N/A'),
+											_CLASS_COLORS))
+_DUNHAM_HANDLES = _DETECTION_HANDLES + tuple(
+					mpatches.Patch(fc = color, ec = 'k', label = label)
+					for label, color in zip(('0+1', 'F', '2', '3', 'N/A'),
+											_CLASS_COLORS))
 
 ##### Plotting and Analysis Functions #####
 
@@ -23,33 +47,34 @@ from astropy import units
 # Keywords:
 # flux - Peak brightnesses for all sources (float array) -- required.
 # peakr - calculated peak ratios for all sources (float array) -- required.
+# proto - protostellar class codes for all objects, see encode_proto
+#		(int8 array) -- required.
+# solid - array denoting whether sources are solid (1, found in all maps) or
+#		weak (0, not found in all maps) (int array) -- requred.
+# orion - Are the sources in Orion A/B, True/False or 'TRUE'/'FALSE'
+#		(boolean or string) -- required.
 # y_hi - upper plotting range for y, should be calculated beforehand to prevent
 # 		aliasing of bright or faint signals (float).
 # y_lo - lower plotting range for y, same considerations as above (float).
-# proto - protostellar classes for all objects (string array) -- required.
-# solid - array denoting whether sources are solid (1, found in all maps) or
-#		weak (0, not found in all maps) (int array) -- requred.
-# orion - Are the sources in Orion A/B (boolean) -- required.
 
 ################################################################################
-def peakr_scatterplot(flux, peakr, y_hi=1.25, y_lo=0.8, proto, solid, orion):
+def peakr_scatterplot(flux, peakr, proto, solid, orion, y_hi=1.25, y_lo=0.8):
 
 	#Set the x-range.
-	x_hi = max(flux)*1.1
+	x_hi = np.amax(flux)*1.1
 	x_lo = 0
 
 	#Plot limits and labels.
-	plt.xlabel('Peak Flux (Jy/Beam)')
-	plt.xlim(x_lo,x_hi)
-	plt.ylim(y_lo,y_hi)
+	ax = plt.gca()
+	ax.set_xlabel('Peak Flux (Jy/Beam)')
+	ax.set_xlim(x_lo,x_hi)
+	ax.set_ylim(y_lo,y_hi)
 
 	#Call the legend/scatterplot making function
-	legend_scatter(flux, peakr, proto, solid, orion)
+	legend_scatter(ax, flux, peakr, proto, solid, orion)
 
 	#Plot reference lines.
-	plt.plot((x_lo,x_hi),(1.0,1.0), '-k')
-	plt.plot((x_lo,x_hi),(0.9,0.9), '--k')
-	plt.plot((x_lo,x_hi),(1.1,1.1), '--k')
+	draw_ref_lines(ax)
 #def
 ################################################################################
 
@@ -64,30 +89,33 @@ def peakr_scatterplot(flux, peakr, y_hi=1.25, y_lo=0.8, proto, solid, orion):
 # Keywords:
 # flux - Peak brightnesses for all sources (float array) -- required.
 # off - Calculated peak offsets for all sources (float array) -- required.
-# y_hi - Upper plotting range for y (float).
-# y_lo - Lower plotting range for y (float).
-# proto - Protostellar classes for all objects (string array) -- required.
+# proto - Protostellar class codes for all objects, see encode_proto
+#		(int8 array) -- required.
 # solid - Array denoting whether sources are solid (1, found in all maps) or
 #		weak (0, not found in all maps) (int array) -- requred.
-# orion - Are the sources in Orion A/B (boolean) -- required.
+# orion - Are the sources in Orion A/B, True/False or 'TRUE'/'FALSE'
+#		(boolean or string) -- required.
+# y_hi - Upper plotting range for y (float).
+# y_lo - Lower plotting range for y (float).
 
 ################################################################################
-def off_scatterplot(flux, off, y_hi=7, y_lo=-7, proto, solid, orion):
+def off_scatterplot(flux, off, proto, solid, orion, y_hi=7, y_lo=-7):
 
 	#Set the x-range.
-	x_hi = max(flux)*1.1
+	x_hi = np.amax(flux)*1.1
 	x_lo = 0
 
 	#Plot limits and labels.
-	plt.xlabel('Peak Flux (Jy/Beam)')
-	plt.ylim(y_lo,y_hi)
-	plt.xlim(x_lo,x_hi)
+	ax = plt.gca()
+	ax.set_xlabel('Peak Flux (Jy/Beam)')
+	ax.set_ylim(y_lo,y_hi)
+	ax.set_xlim(x_lo,x_hi)
 
 	#Call the legend/scatterplot making function
-	legend_scatter(flux, off, proto, solid, orion)
+	legend_scatter(ax, flux, off, proto, solid, orion)
 
 	#Plot a reference line.
-	plt.plot((x_lo,x_hi),(0.0,0.0), '-k')
+	ax.axhline(0.0, color='k')
 #def
 ################################################################################
 
@@ -110,25 +138,25 @@ def off_scatterplot(flux, off, y_hi=7, y_lo=-7, proto, solid, orion):
 ################################################################################
 def time_scatterplot(time, peakr, flux, proto, num, t_init, posx, posy):
 
-	#Convert the decimal degrees to HMS strings.
-	ra_deg = Angle(str(posx)+'d')
-	dec_deg = Angle(str(posy)+'d')
-	ra_hms = ra_deg.to_string(unit=units.hour, sep=':', precision=2)
-	dec_dms = dec_deg.to_string(unit=units.degree, sep=':', precision=2)
+	#Convert the decimal degrees to HMS and DMS strings.
+	ra_hms = deg_to_hms(posx)
+	dec_dms = deg_to_dms(posy)
 
 	#Set the x-range.
-	x_hi = max(time)*1.1
-	x_lo = -max(time)*0.1
+	time_max = np.amax(time)
+	x_hi = time_max*1.1
+	x_lo = -time_max*0.1
 	plt.xlim(x_lo, x_hi)
 
 	#Set the y-range.
 	y_hi = 1.25
 	y_lo = 0.75
-	if np.amax(peakr) > 1.25:
-		y_hi = np.amax(peakr)*1.5
+	peakr_max = np.amax(peakr)
+	if peakr_max > 1.25:
+		y_hi = peakr_max*1.5
 	##fi
-	if np.amax(peakr) < 0.75:
-		y_lo = min(peakr)*0.7
+	if peakr_max < 0.75:
+		y_lo = np.amin(peakr)*0.7
 	##fi
 	plt.ylim(y_lo, y_hi)
 
@@ -146,12 +174,37 @@ def time_scatterplot(time, peakr, flux, proto, num, t_init, posx, posy):
 				 xycoords = 'axes fraction', size = 'small')
 
 	#Plot the data.
-	plt.scatter(time, peakr, alpha = 0.6, s = 60, marker = 'o', facecolor = 'r')
+	plt.scatter(time, peakr, alpha = 0.6, s = 60, marker = 'o', facecolor = 'r',
+				rasterized = True)
 
 	#Plot reference lines.
-	plt.plot((x_lo,x_hi),(1.0,1.0), '-k')
-	plt.plot((x_lo,x_hi),(0.9,0.9), '--k')
-	plt.plot((x_lo,x_hi),(1.1,1.1), '--k')
+	draw_ref_lines(plt.gca())
+#def
+################################################################################
+
+
+
+
+### encode_proto ###
+# Convert protostellar class strings to the integer codes in PROTO_CODES. This
+# should be done once when the classes are read, the plotting functions take
+# the codes.
+#
+# Keywords:
+# proto - Protostellar classes (string array) -- required.
+#
+# Returns:
+# proto_codes - Class codes, -1 for unknown classes (int8 array).
+################################################################################
+def encode_proto(proto):
+
+	#Look up each distinct class once.
+	uniq_proto, proto_inv = np.unique(proto, return_inverse=True)
+	uniq_codes = np.array([PROTO_CODES.get(p, -1) for p in uniq_proto],
+						  dtype=np.int8)
+
+	return uniq_codes[proto_inv.ravel()].reshape(np.shape(proto))
+
 #def
 ################################################################################
 
@@ -164,6 +217,9 @@ def time_scatterplot(time, peakr, flux, proto, num, t_init, posx, posy):
 # Keywords:
 # img_name - Array of image names (in .sdf format) corresponding to images
 # 			that will have the time calculated -- required.
+# call_kappa - Run the KAPPA setup script in a separate shell first (boolean).
+#			This doesn't change the environment of this process, so KAPPA
+#			must already be set up if starlink.hds isn't available.
 #
 # Returns:
 # obs_time - Elapsed time between each observation and the first observation
@@ -171,7 +227,9 @@ def time_scatterplot(time, peakr, flux, proto, num, t_init, posx, posy):
 # t_initial - The date of the first observation, corresponds with obs_time[0]
 #			and is the zero point for obs_time[i] (string).
 ################################################################################
-def get_obs_days(img_name):
+def get_obs_days(img_name, call_kappa=False):
+
+	n_sdf = len(img_name)
 
 	#If the user needs kappa called then do that.
 	if call_kappa == True:
@@ -180,30 +238,18 @@ def get_obs_days(img_name):
 
 	HST_end = np.empty(n_sdf, dtype='O')
 
-	#Pipe the output of the fitsval call into an array.
-	for i in range( len( img_name ) ):
-		date_command = '$KAPPA_DIR/fitsval ndf='+img_name[i]+' keyword=HSTEND'
-		cur_process = subprocess.Popen(date_command, shell=True,
-										stdout=subprocess.PIPE)
-		cur_stdout = cur_process.communicate()
-		HST_end[i] = str(cur_stdout[0])[2:-3]
-
-	obs_time = np.zeros(n_sdf)
-	t_format = '%Y-%m-%dT%H:%M:%S'
-
-	#Iterate over all observations, comparing their time to the first
-	# observations to get an elapsed time in days.
-	for i in range(n_sdf-1):
-		delta_t = dt.strptime(HST_end[i+1], t_format) - dt.strptime(HST_end[0],
-																	 t_format)
-		#determine the total time in days
-		days = delta_t.days
-		seconds = delta_t.seconds/864000.0
-		obs_time[i+1] = seconds+days
+	#Read the end time of each observation.
+	for i in range( n_sdf ):
+		HST_end[i] = read_fits_keyword(img_name[i], 'HSTEND')
 	###i
 
+	#Parse all of the dates at once and find the elapsed time in days since
+	# the first observation.
+	obs_dates = np.array(HST_end, dtype='datetime64[us]')
+	obs_time = (obs_dates - obs_dates[0]) / np.timedelta64(1, 'D')
+
 	#Format the starting date for further plotting.
-	t_initial = dt.strptime(HST_end[0], t_format).strftime('%Y-%b-%d')
+	t_initial = obs_dates[0].astype(object).strftime('%Y-%b-%d')
 
 	return obs_time, t_initial
 
@@ -215,301 +261,155 @@ def get_obs_days(img_name):
 ### legend_scatter ###
 # Plot sources and create a legend with colouring corresponding to the
 # protostellar classification and shapes corresponding to the detection type.
+# The points are rasterized so that PDFs with many sources stay small, their
+# resolution is set by the dpi passed to savefig.
 #
 # Keywords:
+# ax - The axis to plot on (matplotlib Axes) -- required.
 # flux - Peak flux of the sources being plotted (float array) -- required.
 # variation - The variation being plotted (float array) -- required.
-# proto - The protostellar classes of the sources (string array) -- required.
+# proto - The protostellar class codes of the sources, see encode_proto
+#		(int8 array) -- required.
 # solid - Array denoting whether sources are solid (1, found in all maps) or
 #		weak (0, not found in all maps) (int array) -- requred.
-# orion - Are the sources in Orion A/B (boolean) -- required.
+# orion - Are the sources in Orion A/B, True/False or 'TRUE'/'FALSE'
+#		(boolean or string) -- required.
 
 ################################################################################
-def legend_scatter(flux, variation, proto, solid, orion):
-
-	#If we are in Orion use Megeath nomenclature.
-	if orion == 'TRUE':
-
-		#Declare some tracking arrays.
-		where_classP = np.where(proto == 'P')[0]
-		where_classD = np.where(proto == 'D')[0]
-		where_classFP = np.where(proto == 'FP')[0]
-		where_classRP = np.where(proto == 'RP')[0]
-		where_classNA = np.where(proto == 'NA')[0]
-		where_solid = np.where(solid == 1)[0]
-		where_weak = np.where(solid == 0)[0]
-		legend_handle_check = np.zeros(7)
-
-		#Check for protostars.
-		if len(where_classP) > 0:
-			#Figure out which class P sources are solid and weak.
-			where_classP_solid = np.where(proto[where_solid] == 'P')[0]
-			where_classP_weak = np.where(proto[where_weak] == 'P')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classP_solid]],
-						variation[where_solid[where_classP_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='r')
-			plt.scatter(flux[where_weak[where_classP_weak]],
-						variation[where_weak[where_classP_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='r')
-			legend_handle_check[2] = 1
-
-		##fi
-
-		#Check for disks.
-		if len(where_classD) > 0:
-			#Figure out which class D sources are solid and weak.
-			where_classD_solid = np.where(proto[where_solid] == 'D')[0]
-			where_classD_weak = np.where(proto[where_weak] == 'D')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classD_solid]],
-					    variation[where_solid[where_classD_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='b')
-			plt.scatter(flux[where_weak[where_classD_weak]],
-							 variation[where_weak[where_classD_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='b')
-			legend_handle_check[3] = 1
-		##fi
-
-		#Check for faint protostars.
-		if len(where_classFP) > 0:
-			#Figure out which class FP sources are solid and weak.
-			where_classFP_solid = np.where(proto[where_solid] == 'FP')[0]
-			where_classFP_weak = np.where(proto[where_weak] == 'F{P')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classFP_solid]],
-						variation[where_solid[where_classFP_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='m')
-			plt.scatter(flux[where_weak[where_classFP_weak]],
-						variation[where_weak[where_classFP_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='m')
-
-			legend_handle_check[4] = 1
-		##fi
-
-		#Check for red protostars.
-		if len(where_classRP) > 0:
-			#Figure out which class RP sources are solid and weak.
-			where_classRP_solid = np.where(proto[where_solid] == 'RP')[0]
-			where_classRP_weak = np.where(proto[where_weak] == 'RP')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classRP_solid]],
-						variation[where_solid[where_classRP_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='y')
-			plt.scatter(flux[where_weak[where_classRP_weak]],
-						variation[where_weak[where_classRP_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='y')
-			legend_handle_check[5] = 1
-		##fi
-
-		#Check for sources that aren't matched.
-		if len(where_classNA) > 0:
-			#Figure out which class NA sources are solid and weak
-			where_classNA_solid = np.where(proto[where_solid] == 'NA')[0]
-			where_classNA_weak = np.where(proto[where_weak] == 'NA')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classNA_solid]],
-						variation[where_solid[where_classNA_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='none')
-			plt.scatter(flux[where_weak[where_classNA_weak]],
-						variation[where_weak[where_classNA_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='none')
-			legend_handle_check[6] = 1
-		##fi
-
-		#Check for solid sources (full identifications).
-		if len(where_solid) > 0:
-			#Scatter plot these sources
-			plt.scatter(flux[where_solid], variation[where_solid], s=60,
-						facecolor='none', edgecolor='k', marker='o')
-			legend_handle_check[0] = 1
-		##fi
-
-		#Check for weak sources (partial identifications).
-		if len(where_weak) > 0:
-			plt.scatter(flux[where_weak], variation[where_weak], s=60,
-						facecolor='none', edgecolor='k', marker='^')
-			legend_handle_check[1] = 1
-		##fi
-
-		#Make all of the legend handles.
-		black_circle = mlines.Line2D((0,0),(0,0), marker = 'o',
-									 mec = 'k', mfc = 'none', mew = 1.2,
-									 ms = 10, linestyle = '', label='Solid')
-		black_triangle = mlines.Line2D((0,1),(0,0),  marker = '^',
-									   mec = 'k', mfc = 'none', mew = 1.2,
-									   ms = 10, linestyle = '', label='Partial')
-		red_patch = mpatches.Patch(fc= 'r', ec = 'k', label='P')
-		blue_patch = mpatches.Patch(fc = 'b', ec = 'k', label='D')
-		magenta_patch = mpatches.Patch(fc = 'm', ec = 'k', label='FP')
-		yellow_patch = mpatches.Patch(fc = 'y', ec = 'k', label='RP')
-		white_patch = mpatches.Patch(fc = 'none', ec = 'k', label='N/A')
-
-		#Make an array of objects to hold the legend handles.
-		legend_handle_temp = np.array([black_circle, black_triangle, red_patch,
-										blue_patch, magenta_patch, yellow_patch,
-										white_patch],dtype='O')
-
-		#Choose the legend handles that correspond to the identified classes.
-		legend_handle_actual = legend_handle_temp[np.where(legend_handle_check
-														   == 1)[0]]
-
-		#Return the current axis object to change the bounds.
-		ax = plt.gca()
-		cur_bounds = ax.get_position()
-		ax.set_position([cur_bounds.x0, cur_bounds.y0, cur_bounds.width * 0.8,
-						 cur_bounds.height])
-
-		#Place the legend off to one side.
-		plt.legend(handles=list(legend_handle_actual), bbox_to_anchor=(1, 0.5),
-				   loc='center left')
+def legend_scatter(ax, flux, variation, proto, solid, orion):
+
+	#If we are in Orion use Megeath nomenclature, otherwise use Dunham
+	# nomenclature.
+	if orion in (True, 'TRUE'):
+		class_codes = [PROTO_CODES[name] for name in ('P','D','FP','RP','NA')]
+		legend_handles = _ORION_HANDLES
+	elif orion in (False, 'FALSE'):
+		class_codes = [PROTO_CODES[name] for name in ('0+1','F','2','3','NA')]
+		legend_handles = _DUNHAM_HANDLES
+	else:
+		raise ValueError("orion must be True/False or 'TRUE'/'FALSE', not "
+						 +repr(orion))
+	##fi
+
+	#Each class gets a partly transparent face colour, looked up by class code.
+	# Classes from the other nomenclature and unknown classes (code -1, which
+	# indexes the extra last entry) are left unfilled.
+	color_table = np.zeros((len(PROTO_CODES)+1, 4))
+	for code, color in zip(class_codes, _CLASS_COLORS):
+		color_table[code] = mcolors.to_rgba(color, 0.6)
+	###code
+	face_colors = color_table[proto]
+
+	#Split the sources by detection type with one boolean mask, every source
+	# is either solid or weak.
+	solid_mask = np.asarray(solid).astype(bool)
+	weak_mask = ~solid_mask
+	legend_handle_check = np.zeros(7, dtype=bool)
+
+	#Check for solid sources (full identifications). Plot them all at once,
+	# the black edges mark the detection type.
+	if np.any(solid_mask):
+		ax.scatter(flux[solid_mask], variation[solid_mask], s=60, marker='o',
+				   facecolor=face_colors[solid_mask], edgecolor='k',
+				   rasterized=True)
+		legend_handle_check[0] = True
 	##fi
 
-	#If we aren't in Orion then use Dunham nomenclature.
-	if orion == 'FALSE':
-
-		#Declare some tracking arrays.
-		where_class01 = np.where(proto == '0+1')[0]
-		where_classF = np.where(proto == 'F')[0]
-		where_class2 = np.where(proto == '2')[0]
-		where_class3 = np.where(proto == '3')[0]
-		where_classNA = np.where(proto == 'NA')[0]
-		where_solid = np.where(solid == 1)[0]
-		where_weak = np.where(solid == 0)[0]
-		legend_handle_check = np.zeros(7)
-
-		#Check for class 0+1 sources.
-		if len(where_class01) > 0:
-			#Figure out which class 01 sources are solid and weak.
-			where_class01_solid = np.where(proto[where_solid] == '0+1')[0]
-			where_class01_weak = np.where(proto[where_weak] == '0+1')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_class01_solid]],
-						variation[where_solid[where_class01_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='r')
-			plt.scatter(flux[where_weak[where_class01_weak]],
-						variation[where_weak[where_class01_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='r')
-			legend_handle_check[2] = 1
-		##fi
-
-		#Check for flat spectrum sources.
-		if len(where_classF) > 0:
-			#Figure out which class F sources are solid and weak.
-			where_classF_solid = np.where(proto[where_solid] == 'F')[0]
-			where_classF_weak = np.where(proto[where_weak] == 'F')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classF_solid]],
-					    variation[where_solid[where_classF_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='b')
-			plt.scatter(flux[where_weak[where_classF_weak]],
-							 variation[where_weak[where_classF_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='b')
-			legend_handle_check[3] = 1
-		##fi
-
-		#Check for class 2 sources
-		if len(where_class2) > 0:
-			#Figure out which class 2 sources are solid and weak.
-			where_class2_solid = np.where(proto[where_solid] == '2')[0]
-			where_class2_weak = np.where(proto[where_weak] == '2')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_class2_solid]],
-						variation[where_solid[where_class2_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='m')
-			plt.scatter(flux[where_weak[where_class2_weak]],
-						variation[where_weak[where_class2_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='m')
-			legend_handle_check[4] = 1
-		##fi
-
-		#Check for class 3 sources.
-		if len(where_class3) > 0:
-			#Figure out which class 3 sources are solid and weak.
-			where_class3_solid = np.where(proto[where_solid] == '3')[0]
-			where_class3_weak = np.where(proto[where_weak] == '3')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_class3_solid]],
-						variation[where_solid[where_class3_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='y')
-			plt.scatter(flux[where_weak[where_class3_weak]],
-						variation[where_weak[where_class3_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='y')
-			legend_handle_check[5] = 1
-		##fi
-
-		#Check for class NA sources.
-		if len(where_classNA) > 0:
-			#Figure out which unmatched sources are solid and weak.
-			where_classNA_solid = np.where(proto[where_solid] == 'NA')[0]
-			where_classNA_weak = np.where(proto[where_weak] == 'NA')[0]
-
-			#Plot the solid and weak points.
-			plt.scatter(flux[where_solid[where_classNA_solid]],
-						variation[where_solid[where_classNA_solid]],
-							 alpha=0.6, s=60, marker='o', facecolor='none')
-			plt.scatter(flux[where_weak[where_classNA_weak]],
-						variation[where_weak[where_classNA_weak]],
-							 alpha=0.6, s=60, marker='^', facecolor='none')
-			legend_handle_check[6] = 1
-		##fi
-
-		#Check for solid sources (full identifications).
-		if len(where_solid) > 0:
-			#Scatter plot these sources.
-			plt.scatter(flux[where_solid], variation[where_solid], s=60,
-						color='none', edgecolor='k', marker='o')
-			legend_handle_check[0] = 1
-		##fi
-
-		#Check for weak sources (partial identifications).
-		if len(where_weak) > 0:
-			#Scatter plot these sources.
-			plt.scatter(flux[where_weak], variation[where_weak], s=60,
-						color='none', edgecolor='k', marker='^')
-			legend_handle_check[1] = 1
-		##fi
-
-		#Make all of the legend handles.
-		black_circle = mlines.Line2D((0,0),(0,0), marker = 'o',
-									 mec = 'k', mfc = 'none', mew = 1.2,
-									 ms = 10, linestyle = '', label='Solid')
-		black_triangle = mlines.Line2D((0,1),(0,0),  marker = '^',
-									   mec = 'k', mfc = 'none', mew = 1.2,
-									   ms = 10, linestyle = '', label='Partial')
-		red_patch = mpatches.Patch(fc = 'r', ec = 'k', label='0+1')
-		blue_patch = mpatches.Patch(fc = 'b', ec = 'k', label='F')
-		magenta_patch = mpatches.Patch(fc = 'm', ec = 'k', label='2')
-		yellow_patch = mpatches.Patch(fc = 'y', ec = 'k', label='3')
-		white_patch = mpatches.Patch(fc = 'none', ec = 'k', label='N/A')
-
-		#Make an array of objects to hold the legend handles.
-		legend_handle_temp = np.array([black_circle, black_triangle, red_patch,
-										blue_patch, magenta_patch, yellow_patch,
-										white_patch],dtype='O')
-
-		#Choose the legend handles that correspond to the identified classes.
-		legend_handle_actual = legend_handle_temp[np.where(legend_handle_check
-														   == 1)[0]]
-
-		#Return the current axis object to change the bounds.
-		ax = plt.gca()
-		cur_bounds = ax.get_position()
-		ax.set_position([cur_bounds.x0, cur_bounds.y0, cur_bounds.width * 0.8,
-						 cur_bounds.height])
-
-		#Place the legend off to one side.
-		plt.legend(handles=list(legend_handle_actual), bbox_to_anchor=(1, 0.5),
-				   loc='center left')
+	#Check for weak sources (partial identifications).
+	if np.any(weak_mask):
+		ax.scatter(flux[weak_mask], variation[weak_mask], s=60, marker='^',
+				   facecolor=face_colors[weak_mask], edgecolor='k',
+				   rasterized=True)
+		legend_handle_check[1] = True
 	##fi
+
+	#Check which classes are present.
+	legend_handle_check[2:] = np.isin(class_codes, proto)
+
+	#Choose the legend handles that correspond to the identified classes.
+	legend_handle_actual = [handle for handle, check
+							in zip(legend_handles, legend_handle_check)
+							if check]
+
+	#Shrink the axis to make room for the legend.
+	cur_bounds = ax.get_position()
+	ax.set_position([cur_bounds.x0, cur_bounds.y0, cur_bounds.width * 0.8,
+					 cur_bounds.height])
+
+	#Place the legend off to one side.
+	ax.legend(handles=legend_handle_actual, bbox_to_anchor=(1, 0.5),
+			  loc='center left')
+#def
+################################################################################
+
+
+
+
+### draw_ref_lines ###
+# Draw the reference lines for peak ratio plots: a solid line at 1 and dashed
+# lines at 0.9 and 1.1. The lines span the full width of the axis.
+#
+# Keywords:
+# ax - The axis to draw the lines on (matplotlib Axes) -- required.
+
+################################################################################
+def draw_ref_lines(ax):
+
+	ax.axhline(1.0, color='k', linestyle='-')
+	ax.axhline(0.9, color='k', linestyle='--')
+	ax.axhline(1.1, color='k', linestyle='--')
+#def
+################################################################################
+
+
+
+
+### deg_to_hms ###
+# Format an angle in decimal degrees as an H:MM:SS.SS string.
+#
+# Keywords:
+# deg - Angle in degrees (float) -- required.
+#
+# Returns:
+# hms - The formatted angle (string).
+################################################################################
+def deg_to_hms(deg):
+
+	sign = '-' if deg < 0 else ''
+
+	#Work in hundredths of a second so that rounding carries into the minutes.
+	csec = int(round(abs(deg) / 15.0 * 360000))
+	hh, csec = divmod(csec, 360000)
+	mm, csec = divmod(csec, 6000)
+
+	return '{}{:d}:{:02d}:{:05.2f}'.format(sign, hh, mm, csec / 100.0)
+
+#def
+################################################################################
+
+
+
+
+### deg_to_dms ###
+# Format an angle in decimal degrees as a D:MM:SS.SS string.
+#
+# Keywords:
+# deg - Angle in degrees (float) -- required.
+#
+# Returns:
+# dms - The formatted angle (string).
+################################################################################
+def deg_to_dms(deg):
+
+	sign = '-' if deg < 0 else ''
+
+	#Work in hundredths of an arcsecond so that rounding carries into the
+	# arcminutes.
+	csec = int(round(abs(deg) * 360000))
+	dd, csec = divmod(csec, 360000)
+	mm, csec = divmod(csec, 6000)
+
+	return '{}{:d}:{:02d}:{:05.2f}'.format(sign, dd, mm, csec / 100.0)
+
 #def
 ################################################################################
@@ -6,7 +6,7 @@ def run_TC_pipeline(dirname,kern_name,param_file,beam_fwhm=14.5,crop_radius=1200
 
   from TCGaussclumpsFunctions import run_gaussclumps,get_noise
   from TCOffsetFunctions_20160624 import source_match,cull_matches
-  from TCPrepFunctions import crop_image,smooth_image,unitconv_image,prepare_image
+  from TCPrepFunctions import crop_image,smooth_image,unitconv_image,prepare_image,prepare_images
   import time
   import os
   import datetime
@@ -115,6 +115,17 @@ def run_TC_pipeline(dirname,kern_name,param_file,beam_fwhm=14.5,crop_radius=1200
   calib_results.write('PONG\t|\tDate\t|\tN Matches\t|\tN Survived Cull\t|\tAvg X_off\t|\tAvg Y_off\t|\tAvg Peak Ratio\t|\tAvg Radius Ratio\t|\tAvg X_off error\t|\tAvg Y_off error\t|\tAvg Peak Ratio error\t|\tAvg Radius Ratio error\t|\n')
   calib_results.write('-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------\n')
 
+  #Crop and smooth all of the images at once, in parallel
+  print('\nCropping and Smoothing the files...\n')
+  logging.info(' Cropping and Smoothing the files...')
+  start_time=time.time()
+
+  prepare_images(img_names, kern_name, kern_fwhm, jypbm_conv=jypbm_conv,beam_fwhm=beam_fwhm, crop_radius=crop_radius, crop_method=crop_method)
+
+  end_time=time.time()
+  print('\nCropping and Smoothing finished in '+str(round(end_time-start_time,2))+' Seconds\n')
+  logging.info('Cropping and Smoothing finished in '+str(round(end_time-start_time,2))+' Seconds \n\n')
+
   #Now, run the pipeline in a loop over all the given images:
  
   for eachfile in img_names:
@@ -127,17 +138,6 @@ def run_TC_pipeline(dirname,kern_name,param_file,beam_fwhm=14.5,crop_radius=1200
     print('#################################')
     print('#################################\n\n')
   
-    #Crop and smooth the image
-    print('\nCropping and Smoothing the file...\n')
-    logging.info(' Cropping and Smoothing the file...')
-    start_time=time.time()
-  
-    prepare_image(eachfile, kern_name, kern_fwhm, jypbm_conv=jypbm_conv,beam_fwhm=beam_fwhm, crop_radius=crop_radius, crop_method=crop_method)
-  
-    end_time=time.time()
-    print('\nCropping and Smoothing finished in '+str(round(end_time-start_time,2))+' Seconds\n')
-    logging.info('Cropping and Smoothing finished in '+str(round(end_time-start_time,2))+' Seconds \n\n')
-
     #Identify the sources and produce Gaussclump catalogs
     print('\nRunning GaussClumps...\n')
     logging.info(' Running GaussClumps...')
@@ -194,7 +194,6 @@ def run_TC_pipeline(dirname,kern_name,param_file,beam_fwhm=14.5,crop_radius=1200
   os.system('mv calibration_results.txt TC-'+str(date)+'/calib-results-txt/')
   os.system('rm -f *crop.sdf')
   os.system('rm -f *crop_smooth.sdf')
-  os.system('rm -f crop.ini')
   os.system('rm -f findclumpscript.sh')
   os.system('rm -f disp.dat')
   os.system('rm -f log.group')